@@ -1,23 +1,65 @@
 import os
 import re
+import json
 import subprocess
 import platform
-from typing import Optional
+import shutil
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+try:
+    from send2trash import send2trash   # opcional: originales a la papelera
+except ImportError:
+    send2trash = os.remove
 
 directory = os.path.dirname(os.path.realpath(__file__))
 out_dir = os.path.join(directory, "encoded")
 os.makedirs(out_dir, exist_ok=True)
 
+# Originales ya codificados; se borran al final del lote, no en mitad del encode
+to_delete = []
+# Se activa con Ctrl-C: no se lanzan más ffmpeg (ni reintentos) tras la señal
+stop = threading.Event()
+
 VIDEO_EXTS = {".mp4", ".mkv", ".mov", ".avi"}
 
-def is_video(f: str) -> bool:
-    return os.path.splitext(f.lower())[1] in VIDEO_EXTS
+# Rutas absolutas resueltas una vez: cada subprocess evita buscar en PATH.
+# Sin preexec_fn/cwd/pass_fds, CPython lanza con vfork/posix_spawn en vez de fork.
+# close_fds se deja por defecto: con varios ffmpeg en hilos, heredar pipes ajenos
+# retrasaría el EOF de stderr de otros jobs.
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+NVIDIA_SMI = shutil.which("nvidia-smi") or "nvidia-smi"
+
+_SEASON_EP = re.compile(r"s(\d{2})e(\d{2})", re.IGNORECASE)
+_SERIES_NUM = re.compile(r"^\s*(.+?)[\s_]+(\d{1,4})\b")
+_SLUG_DROP = re.compile(r"[^\w\s-]")
+_SLUG_COLLAPSE = re.compile(r"[\s-]+")
+
+def iter_videos(root: str, top: bool = True):
+    # Recorrido con scandir (ignora encoded/); solo se construyen rutas de vídeos
+    try:
+        it = os.scandir(root)
+    except OSError:
+        if top:
+            raise
+        return  # como os.walk: las subcarpetas ilegibles se saltan
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                if e.name != "encoded":
+                    yield from iter_videos(e.path, top=False)
+            elif os.path.splitext(e.name)[1].lower() in VIDEO_EXTS:
+                yield e.path
 
 def slugify(text: str) -> str:
     # seguro para Windows/macOS/Linux
     t = text.lower()
-    t = re.sub(r"[^\w\s-]", "", t)          # quita puntuación rara
-    t = re.sub(r"[\s-]+", "_", t).strip("_")
+    t = _SLUG_DROP.sub("", t)          # quita puntuación rara
+    t = _SLUG_COLLAPSE.sub("_", t).strip("_")
     return t
 
 def extract_episode_stem(filename: str) -> Optional[str]:
@@ -27,15 +69,14 @@ def extract_episode_stem(filename: str) -> Optional[str]:
       2) "Serie 005 - ..." / "Serie_047_- ..." -> "serie_e005" / "serie_e047"
     """
     name = os.path.splitext(filename)[0]
-    low = name.lower()
 
     # 1) sXXeYY
-    m = re.search(r"s(\d{2})e(\d{2})", low)
+    m = _SEASON_EP.search(name)
     if m:
         return f"s{m.group(1)}e{m.group(2)}"
 
     # 2) "Serie 005 ..." / "Serie_047 ..."
-    m = re.match(r"^\s*(.+?)[\s_]+(\d{1,4})\b", name)
+    m = _SERIES_NUM.match(name)
     if m:
         series = slugify(m.group(1))
         ep_num = int(m.group(2))
@@ -44,18 +85,8 @@ def extract_episode_stem(filename: str) -> Optional[str]:
 
     return None
 
-def get_src_fps(path: str) -> float:
-    r = subprocess.run(
-        [
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=avg_frame_rate",
-            "-of", "default=nk=1:nw=1",
-            path
-        ],
-        capture_output=True, text=True
-    )
-    s = (r.stdout or "").strip()
+def parse_rate(s: str) -> float:
+    s = (s or "").strip()
     if not s or s == "0/0":
         return 0.0
     if "/" in s:
@@ -69,120 +100,343 @@ def get_src_fps(path: str) -> float:
     except Exception:
         return 0.0
 
+def probe_file(path: str) -> dict:
+    """
+    Un ffprobe por fichero: fps, ancho, alto y SAR del primer vídeo y
+    (codec, canales, bitrate) del primer audio. Campos desconocidos -> 0.0 / None;
+    "ok" es False si ffprobe falló (no se cachea).
+    """
+    r = subprocess.run(
+        [
+            FFPROBE, "-v", "error",
+            "-threads", "1",
+            "-show_entries",
+            "stream=codec_type,codec_name,channels,bit_rate,avg_frame_rate,width,height,sample_aspect_ratio",
+            "-of", "json",
+            path
+        ],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    ok = r.returncode == 0
+    try:
+        streams = json.loads(r.stdout or b"{}").get("streams") or []
+    except ValueError:
+        streams = []
+        ok = False
+
+    info = {"ok": ok, "fps": 0.0, "width": None, "height": None, "sar": None, "audio": None}
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    if video:
+        info["fps"] = parse_rate(video.get("avg_frame_rate", ""))
+        info["width"] = video.get("width")
+        info["height"] = video.get("height")
+        info["sar"] = video.get("sample_aspect_ratio")
+    if audio:
+        try:
+            br = int(audio.get("bit_rate"))
+        except (TypeError, ValueError):
+            br = None
+        info["audio"] = (audio.get("codec_name"), audio.get("channels"), br)
+    return info
+
+def probe_all(files: list) -> dict:
+    # ffprobe en paralelo: un lote de N ficheros no paga N arranques en serie
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return dict(zip(files, ex.map(probe_file, files)))
+
+# Subir al cambiar los campos de probe_file(): invalida las cachés antiguas
+PROBE_CACHE_VERSION = 2
+
+def _probe_cache_key(path: str) -> str:
+    st = os.stat(path)
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+def probe_cached(files: list, cache_path: str) -> dict:
+    """
+    probe_all() con caché en disco por (ruta, mtime, tamaño): en ejecuciones
+    repetidas solo se sondean los ficheros nuevos o modificados.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as fh:
+            data = json.load(fh)
+    except (OSError, ValueError):
+        data = {}
+    if not isinstance(data, dict) or data.get("version") != PROBE_CACHE_VERSION:
+        data = {}
+    cache = data.get("entries") or {}
+
+    keys = {f: _probe_cache_key(f) for f in files}
+    misses = [f for f in files if keys[f] not in cache]
+    probes = {f: cache[keys[f]] for f in files if keys[f] in cache}
+    probes.update(probe_all(misses))
+    for info in probes.values():
+        if info["audio"] is not None:
+            info["audio"] = tuple(info["audio"])    # JSON lo devuelve como lista
+
+    # Solo se guarda lo pendiente y bien sondeado: lo ya codificado ya no tiene
+    # fuente, y un ffprobe fallido debe repetirse en la próxima ejecución
+    entries = {keys[f]: probes[f] for f in files if probes[f].get("ok")}
+    tmp = cache_path + ".part"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"version": PROBE_CACHE_VERSION, "entries": entries}, fh)
+    os.replace(tmp, cache_path)
+    return probes
+
+def audio_args(audio) -> list:
+    # AAC estéreo de <=128k ya vale tal cual: copia sin decodificar/recodificar
+    if audio is not None:
+        codec, channels, br = audio
+        if codec == "aac" and channels == 2 and br is not None and br <= 128000:
+            return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", "96k", "-ac", "2"]
+
 def pick_fps_mode(src_fps: float):
+    """
+    Devuelve (fps, gop, keyint_min, motivo, needs_resample); sin resample
+    si la fuente ya está a la cadencia elegida.
+    """
     fps_23976 = 24000 / 1001
     if src_fps <= 0:
-        return ("25", 50, 50, "fallback->25")
+        return ("25", 50, 50, "fallback->25", True)
     if abs(src_fps - 25.0) <= abs(src_fps - fps_23976):
-        return ("25", 50, 50, f"{src_fps:.3f}->25")
+        return ("25", 50, 50, f"{src_fps:.3f}->25", abs(src_fps - 25.0) > 0.01)
     else:
-        return ("24000/1001", 48, 48, f"{src_fps:.3f}->23.976")
+        return ("24000/1001", 48, 48, f"{src_fps:.3f}->23.976", abs(src_fps - fps_23976) > 0.01)
 
-def ffmpeg_has_encoder(encoder_name: str) -> bool:
-    r = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True)
-    return encoder_name in (r.stdout or "")
+@lru_cache(maxsize=None)
+def _encoder_list() -> bytes:
+    # Un solo `ffmpeg -encoders` por ejecución; basta buscar en bytes, sin decodificar
+    r = subprocess.run([FFMPEG, "-hide_banner", "-encoders"],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return r.stdout
 
-def cuda_available() -> bool:
-    if not ffmpeg_has_encoder("h264_nvenc"):
-        return False
-    r = subprocess.run(["nvidia-smi"], capture_output=True, text=True)
-    return r.returncode == 0
+@lru_cache(maxsize=None)
+def _hwaccel_list() -> bytes:
+    r = subprocess.run([FFMPEG, "-hide_banner", "-hwaccels"],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return r.stdout
 
-def mac_videotoolbox_available() -> bool:
-    if platform.system() != "Darwin":
-        return False
-    r = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True)
-    return "h264_videotoolbox" in (r.stdout or "")
+def _nvidia_gpu() -> Optional[str]:
+    try:
+        r = subprocess.run(
+            [NVIDIA_SMI, "--query-gpu=name,driver_version", "--format=csv,noheader"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+    if r.returncode != 0:
+        return None
+    return r.stdout.decode("utf-8", "replace").strip()
 
-# --- Scan input files (ignore encoded/) ---
-files = []
-for root, dirs, names in os.walk(directory):
-    dirs[:] = [d for d in dirs if d != "encoded"]
-    for n in names:
-        if is_video(n):
-            files.append(os.path.join(root, n))
+@lru_cache(maxsize=None)
+def capabilities() -> Mapping[str, object]:
+    """
+    Detecta el hardware una sola vez por ejecución:
+    como mucho un `-encoders`, un `-hwaccels` y un nvidia-smi.
+    """
+    enc = _encoder_list()
+    # Nunca "-hwaccel auto": elegimos explícitamente cuda/videotoolbox
+    hw = _hwaccel_list().split()
+    gpu = _nvidia_gpu() if b"h264_nvenc" in enc else None
+    return MappingProxyType({
+        "nvenc": gpu is not None,
+        "vtb": platform.system() == "Darwin" and b"h264_videotoolbox" in enc,
+        "cuda_hwaccel": b"cuda" in hw,
+        "vtb_hwaccel": b"videotoolbox" in hw,
+        "gpu": gpu,
+    })
 
-use_nvenc = cuda_available()
-use_vtb = mac_videotoolbox_available()
-print(f"NVENC: {use_nvenc} | VideoToolbox: {use_vtb} | OS: {platform.system()}")
+def encode_workers(use_nvenc: bool, use_vtb: bool) -> int:
+    # NVENC/VTB aceptan varias sesiones a la vez; en CPU repartimos núcleos
+    if use_nvenc or use_vtb:
+        return 2
+    return max(1, min((os.cpu_count() or 2) // 2, 4))
 
-for f in files:
-    base = os.path.basename(f)
-    stem = extract_episode_stem(base)
+def build_job_args(f: str, out: str, info: dict, use_nvenc: bool, use_vtb: bool,
+                   hwaccel: bool = True):
+    """
+    Argumentos ffmpeg para un fichero:
+    devuelve (args de entrada, args de salida, encoder, motivo fps).
+    Con hwaccel=False se decodifica y filtra por software (el encoder no cambia).
+    """
+    fps_str, gop, keymin, reason, needs_resample = pick_fps_mode(info["fps"])
 
-    if stem is None:
-        stem = slugify(os.path.splitext(base)[0])
-        print(f"⚠️  No se pudo extraer episodio de: {base} -> usando: {stem}")
+    # Fuente ya a 640x480 con píxel cuadrado: sin escalar ni recortar
+    native = (info.get("width"), info.get("height")) == (640, 480) and info.get("sar") in ("1:1", "1")
 
-    out = os.path.join(out_dir, f"{stem}.mkv")
-    if os.path.exists(out):
-        continue
+    vf = "hqdn3d=1.2:1.2:3:3"
+    if not native:
+        vf += ",scale=640:480:force_original_aspect_ratio=increase,crop=640:480,setsar=1"
+    hw_in = []
 
-    src_fps = get_src_fps(f)
-    fps_str, gop, keymin, reason = pick_fps_mode(src_fps)
+    # Decodificación por hardware: el escalado va en GPU y solo se descarga el frame pequeño
+    if hwaccel and use_nvenc and capabilities()["cuda_hwaccel"]:
+        hw_in = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda", "-extra_hw_frames", "4"]
+        # Sin hqdn3d en GPU: el spatial AQ de NVENC enmascara el ruido.
+        # Si no hay que escalar, los frames CUDA van directos a NVENC.
+        vf = None if native else (
+            "scale_cuda=640:480:force_original_aspect_ratio=increase:interp_algo=lanczos,"
+            "hwdownload,format=nv12,crop=640:480,setsar=1")
+    elif hwaccel and use_vtb and capabilities()["vtb_hwaccel"]:
+        hw_in = ["-hwaccel", "videotoolbox"]
 
-    vf = "hqdn3d=1.2:1.2:3:3,scale=640:480:force_original_aspect_ratio=increase,crop=640:480,setsar=1"
+    in_args = [*hw_in, "-i", f]
 
     # Base común (sin subs, solo v+a)
     cmd = [
-        "ffmpeg", "-y",
-        "-i", f,
         "-sn",
         "-map", "0:v:0",
         "-map", "0:a:0?",
-        "-vf", vf,
+    ]
+    if vf:
+        cmd += ["-vf", vf]
 
-        "-r", fps_str,
+    # Solo se re-muestrea a CFR si la fuente no coincide ya con el fps destino
+    # -vsync y no -fps_mode: este último no existe antes de FFmpeg 5.1
+    if needs_resample:
+        cmd += ["-r", fps_str, "-vsync", "cfr"]
+    else:
+        cmd += ["-vsync", "passthrough"]
+
+    cmd += [
+        "-avoid_negative_ts", "make_zero",
         "-g", str(gop),
         "-keyint_min", str(keymin),
         "-sc_threshold", "0",
 
-        "-b:v", "700k",
-        "-maxrate", "900k",
-        "-bufsize", "1800k",
-
-        "-c:a", "aac",
-        "-b:a", "96k",
-        "-ac", "2",
-
-        "-f", "matroska",
+        *audio_args(info["audio"]),
     ]
 
     if use_nvenc:
         cmd += [
             "-c:v", "h264_nvenc",
-            "-preset", "p4",
+            "-gpu", "0",
+            "-preset", "p1",
+            "-tune", "hq",
+            "-multipass", "0",
+            "-rc", "cbr",
+            "-b:v", "700k",
+            "-maxrate", "900k",
+            "-bufsize", "1400k",
             "-profile:v", "baseline",
             "-bf", "0",
             "-refs", "1",
-            "-rc", "vbr",
             "-rc-lookahead", "0",
-            "-spatial_aq", "0",
+            "-spatial_aq", "1",
+            "-aq-strength", "8",
             "-temporal_aq", "0",
         ]
         enc = "h264_nvenc"
     elif use_vtb:
         cmd += [
             "-c:v", "h264_videotoolbox",
+            "-b:v", "700k",
+            "-maxrate", "900k",
+            "-bufsize", "1800k",
             "-profile:v", "baseline",
+            "-bf", "0",
         ]
         enc = "h264_videotoolbox"
     else:
+        x264_threads = 4 if encode_workers(False, False) == 1 else 2
         cmd += [
             "-c:v", "libx264",
+            "-b:v", "700k",
+            "-maxrate", "900k",
+            "-bufsize", "1800k",
+            # frame-threads en vez de slices; con varios workers, 2 hilos por job ~ núcleos
+            "-threads", str(x264_threads),
+            "-filter_threads", "2",
             "-preset", "veryfast",
             "-tune", "fastdecode",
             "-profile:v", "baseline",
             "-level", "3.0",
             "-pix_fmt", "yuv420p",
-            "-x264-params", "bframes=0:ref=1:cabac=0:weightp=0",
+            "-x264-params", "bframes=0:ref=1:cabac=0:weightp=0:sliced-threads=0:lookahead-threads=1",
         ]
         enc = "libx264"
 
-    cmd.append(out)
+    # Se escribe en .part: un corte a medias no deja un .mkv que parezca completo
+    cmd += ["-f", "matroska", out + ".part"]
+    return in_args, cmd, enc, reason
+
+def run_ffmpeg(cmd: list, label: str) -> None:
+    # stderr por job para que los logs de varios ffmpeg no se mezclen. Se captura
+    # en bytes: ffmpeg repite tags/nombres en cualquier codificación, y solo se
+    # decodifica (tolerante) si hay que mostrarlo
+    r = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+    if r.returncode != 0:
+        print(f"❌ Error en {label}:\n{r.stderr.decode('utf-8', 'replace')}")
+        raise subprocess.CalledProcessError(r.returncode, cmd, stderr=r.stderr)
+
+def finish(f: str, out: str) -> None:
+    os.replace(out + ".part", out)
+    to_delete.append(f)
 
-    print(f"Encoding {os.path.basename(out)} | src_fps={src_fps:.3f} | mode={reason} | enc={enc}")
-    subprocess.run(cmd, check=True)
+def encode_one(f: str, out: str, info: dict, use_nvenc: bool, use_vtb: bool) -> None:
+    if stop.is_set():
+        return
+    in_args, out_args, enc, reason = build_job_args(f, out, info, use_nvenc, use_vtb)
+    print(f"Encoding {os.path.basename(out)} | src_fps={info['fps']:.3f} | mode={reason} | enc={enc}")
+    try:
+        run_ffmpeg([FFMPEG, "-y", *in_args, *out_args], os.path.basename(f))
+    except subprocess.CalledProcessError as e:
+        # 255 / negativo: ffmpeg cortado por señal (Ctrl-C), no un fallo de decodificación
+        if "-hwaccel" not in in_args or e.returncode == 255 or e.returncode < 0 or stop.is_set():
+            raise
+        # NVDEC/VT no decodifica todo (DivX3, WMV, H.264 4:2:2...): reintento por software
+        print(f"⚠️  Decodificación por hardware fallida, reintentando por software: {os.path.basename(f)}")
+        in_args, out_args, _, _ = build_job_args(f, out, info, use_nvenc, use_vtb, hwaccel=False)
+        run_ffmpeg([FFMPEG, "-y", *in_args, *out_args], os.path.basename(f))
+    finish(f, out)
+
+# --- Scan input files (ignore encoded/) ---
+files = list(iter_videos(directory))
+
+CAPS = capabilities()
+use_nvenc = CAPS["nvenc"]
+use_vtb = CAPS["vtb"]
+print(f"NVENC: {use_nvenc} | VideoToolbox: {use_vtb} | OS: {platform.system()}"
+      + (f" | GPU: {CAPS['gpu']}" if CAPS["gpu"] else ""))
+
+# --- Paso 1: salidas pendientes (lo ya codificado no se vuelve a sondear) ---
+pending = []
+seen_outs = set()
+for f in files:
+    base = os.path.basename(f)
+    stem = extract_episode_stem(base)
+
+    if stem is None:
+        stem = slugify(os.path.splitext(base)[0])
+        print(f"⚠️  No se pudo extraer episodio de: {base} -> usando: {stem}")
 
-    os.remove(f)
-    print(f"Deleted original: {os.path.basename(f)}")
\ No newline at end of file
+    out = os.path.join(out_dir, f"{stem}.mkv")
+    # Dos fuentes con el mismo episodio no deben escribir la misma salida a la vez
+    if out in seen_outs or os.path.exists(out):
+        continue
+    seen_outs.add(out)
+    pending.append((f, out))
+
+# --- Paso 2: ffprobe solo de lo pendiente (y no cacheado) ---
+probes = probe_cached([f for f, _ in pending], os.path.join(out_dir, ".probecache.json"))
+
+# --- Paso 3: encode ---
+try:
+    with ThreadPoolExecutor(max_workers=encode_workers(use_nvenc, use_vtb)) as ex:
+        try:
+            list(ex.map(lambda job: encode_one(job[0], job[1], probes[job[0]], use_nvenc, use_vtb), pending))
+        except KeyboardInterrupt:
+            # Antes de que el with espere a los jobs en cola: que no arranquen
+            stop.set()
+            raise
+finally:
+    # Solo fuentes cuyo .mkv ya está completo; un error no se lleva las demás
+    for f in to_delete:
+        try:
+            send2trash(f)
+        except OSError as e:
+            print(f"⚠️  No se pudo borrar {os.path.basename(f)}: {e}")
+            continue
+        print(f"Deleted original: {os.path.basename(f)}")